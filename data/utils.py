@@ -1,110 +1,161 @@
-import pandas as pd
+import itertools
 import json
+import pandas as pd
+import orjson
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+# (header substring, metric name) pairs per table, in match priority order.
+# Used as a fallback when a row header is not an exact key below.
+LIQUIDITY_PATTERNS = (
+    ('total identifiable intangible assets', 'total_identifiable_intangible_assets'),
+    ('trade names', 'trade_names'),
+    ('developed technology', 'developed_technology'),
+    ('customer relationships', 'customer_relationships'),
+)
+
+BALANCE_PATTERNS = (
+    ('total current assets', 'current_assets'),
+    ('total assets', 'total_assets'),
+    ('total current liabilities', 'current_liabilities'),
+    ('total liabilities', 'total_liabilities'),
+    ('total stockholders equity', 'total_stockholders_equity'),
+    ('cash and cash equivalents', 'cash_and_cash_equivalents'),
+    ('inventories', 'inventory'),
+    ('accounts receivable', 'accounts_receivable'),
+    ('accounts payable', 'accounts_payable'),
+    ('goodwill', 'goodwill'),
+    ('intangible assets net', 'intangible_assets'),
+    ('long-term debt net of current portion', 'long_term_debt'),
+)
+
+INCOME_PATTERNS = (
+    ('sales', 'sales'),
+    ('net earnings', 'net_earnings'),
+    ('basic net earnings per common share', 'basic_eps'),
+    ('diluted net earnings per common share', 'diluted_eps'),
+    ('operating earnings', 'operating_earnings'),
+    ('gross profit', 'gross_profit'),
+    ('depreciation depletion and amortization', 'depreciation_and_amortization'),
+)
+
+CASHFLOW_PATTERNS = (
+    ('net cash provided by operating activities', 'net_cash_operating_activities'),
+    ('net cash used in investing activities', 'net_cash_investing_activities'),
+    ('net cash provided by financing activities', 'net_cash_financing_activities'),
+)
 
-def load_findsum_data(csv_path, text_path, num_rows=10):
-    # Load CSV file
-    df = pd.read_csv(csv_path, sep=',', nrows=num_rows)
+# Exact normalized header -> metric name, checked before the substring fallback.
+# An exact header wins over an earlier, shorter pattern, so e.g. "Basic net
+# earnings per common share" maps to basic_eps rather than net_earnings.
+LIQUIDITY_KEYS = dict(LIQUIDITY_PATTERNS)
+BALANCE_KEYS = dict(BALANCE_PATTERNS)
+INCOME_KEYS = dict(INCOME_PATTERNS)
+CASHFLOW_KEYS = dict(CASHFLOW_PATTERNS)
+
+# Strips thousands separators from numeric table cells
+_COMMA_TABLE = str.maketrans('', '', ',')
+
+# Output column order for batch extraction
+ALL_METRIC_NAMES = tuple(dict.fromkeys(
+    name for patterns in (LIQUIDITY_PATTERNS, BALANCE_PATTERNS, INCOME_PATTERNS, CASHFLOW_PATTERNS)
+    for _, name in patterns
+))
+
+def iter_findsum_text(text_path, num_rows=10):
+    # Stream parsed documents; orjson parses the raw bytes without a separate decode
+    with open(text_path, 'rb') as f:
+        for line in itertools.islice(f, num_rows):
+            try:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # orjson rejects NaN/Infinity tokens that the stdlib parser accepts
+                yield json.loads(line)
+
+def load_findsum_data(csv_path, text_path, num_rows=10, dtype=None, stream=False):
+    # Load CSV file; pass dtype to skip pandas' per-column type inference
+    df = pd.read_csv(csv_path, sep=',', nrows=num_rows, dtype=dtype,
+                     engine='c', low_memory=False, memory_map=True)
     
-    # Load text file
-    with open(text_path, 'r', encoding='utf-8') as f:
-        text_data = [json.loads(line) for _, line in zip(range(num_rows), f)]
+    # Load text file; with stream=True documents are parsed lazily as they are consumed
+    text_data = iter_findsum_text(text_path, num_rows)
+    if not stream:
+        text_data = list(text_data)
     
     return df, text_data
 
-def extract_important_metrics(data):
-    # Initialize a dictionary to store the extracted metrics
-    metrics = {}
-
-    # Helper function to safely extract float values
-    def safe_float(value):
-        try:
-            # Handle cases where the value contains '&' or commas
-            if '&' in value:
-                return float(value.split('&')[1].replace(',', ''))
-            else:
-                return float(value.replace(',', ''))
-        except (ValueError, IndexError):
+def safe_float(value):
+    """Safely convert a table cell to float, returning None when it does not parse."""
+    try:
+        if isinstance(value, (int, float)):
+            return float(value)
+        if value is None or value == '':
             return None
+        # Handle cases where the value contains '&' or commas
+        if '&' in value:
+            value = value.split('&', 2)[1]
+        return float(value.translate(_COMMA_TABLE))
+    except (ValueError, TypeError, AttributeError):
+        return None
 
+def scan_table(items, keys, patterns):
+    """Yield (metric name, raw cell value) for every row of one table that matches keys/patterns."""
+    for item in items:
+        key = item[0].strip().lower()
+        name = keys.get(key)
+        if name is None:
+            name = next((n for s, n in patterns if s in key), None)
+        if name is not None:
+            yield name, item[2]
+
+def iter_table_metrics(doc):
+    """Yield (metric name, raw cell value) for every matching row of a FINDSum document."""
     # Extract liquidity-related metrics
-    if 'mda_liquidity_tables' in data[0]:
-        liquidity_data = data[0]['mda_liquidity_tables'][0]
-        for item in liquidity_data:
-            if 'total identifiable intangible assets' in item[0].lower():
-                metrics['total_identifiable_intangible_assets'] = safe_float(item[2])
-            elif 'trade names' in item[0].lower():
-                metrics['trade_names'] = safe_float(item[2])
-            elif 'developed technology' in item[0].lower():
-                metrics['developed_technology'] = safe_float(item[2])
-            elif 'customer relationships' in item[0].lower():
-                metrics['customer_relationships'] = safe_float(item[2])
-
-    # Extract balance sheet metrics
-    if 'after_mda_tables' in data[0]:
-        balance_sheet_data = data[0]['after_mda_tables'][0]
-        for item in balance_sheet_data:
-            if 'total current assets' in item[0].lower():
-                metrics['current_assets'] = safe_float(item[2])
-            elif 'total assets' in item[0].lower():
-                metrics['total_assets'] = safe_float(item[2])
-            elif 'total current liabilities' in item[0].lower():
-                metrics['current_liabilities'] = safe_float(item[2])
-            elif 'total liabilities' in item[0].lower():
-                metrics['total_liabilities'] = safe_float(item[2])
-            elif 'total stockholders equity' in item[0].lower():
-                metrics['total_stockholders_equity'] = safe_float(item[2])
-            elif 'cash and cash equivalents' in item[0].lower():
-                metrics['cash_and_cash_equivalents'] = safe_float(item[2])
-            elif 'inventories' in item[0].lower():
-                metrics['inventory'] = safe_float(item[2])
-            elif 'accounts receivable' in item[0].lower():
-                metrics['accounts_receivable'] = safe_float(item[2])
-            elif 'accounts payable' in item[0].lower():
-                metrics['accounts_payable'] = safe_float(item[2])
-            elif 'goodwill' in item[0].lower():
-                metrics['goodwill'] = safe_float(item[2])
-            elif 'intangible assets net' in item[0].lower():
-                metrics['intangible_assets'] = safe_float(item[2])
-            elif 'long-term debt net of current portion' in item[0].lower():
-                metrics['long_term_debt'] = safe_float(item[2])
-
-    # Extract income statement metrics
-    if 'after_mda_tables' in data[0]:
-        income_statement_data = data[0]['after_mda_tables'][1]
-        for item in income_statement_data:
-            if 'sales' in item[0].lower():
-                metrics['sales'] = safe_float(item[2])
-            elif 'net earnings' in item[0].lower():
-                metrics['net_earnings'] = safe_float(item[2])
-            elif 'basic net earnings per common share' in item[0].lower():
-                metrics['basic_eps'] = safe_float(item[2])
-            elif 'diluted net earnings per common share' in item[0].lower():
-                metrics['diluted_eps'] = safe_float(item[2])
-            elif 'operating earnings' in item[0].lower():
-                metrics['operating_earnings'] = safe_float(item[2])
-            elif 'gross profit' in item[0].lower():
-                metrics['gross_profit'] = safe_float(item[2])
-            elif 'depreciation depletion and amortization' in item[0].lower():
-                metrics['depreciation_and_amortization'] = safe_float(item[2])
-
-    # Extract cash flow metrics
-    if 'after_mda_tables' in data[0]:
-        cash_flow_data = data[0]['after_mda_tables'][2]
-        for item in cash_flow_data:
-            if 'net cash provided by operating activities' in item[0].lower():
-                metrics['net_cash_operating_activities'] = safe_float(item[2])
-            elif 'net cash used in investing activities' in item[0].lower():
-                metrics['net_cash_investing_activities'] = safe_float(item[2])
-            elif 'net cash provided by financing activities' in item[0].lower():
-                metrics['net_cash_financing_activities'] = safe_float(item[2])
+    if 'mda_liquidity_tables' in doc:
+        yield from scan_table(doc['mda_liquidity_tables'][0], LIQUIDITY_KEYS, LIQUIDITY_PATTERNS)
+
+    if 'after_mda_tables' in doc:
+        after_mda_tables = doc['after_mda_tables']
+        # Balance sheet, income statement and cash flow metrics
+        yield from scan_table(after_mda_tables[0], BALANCE_KEYS, BALANCE_PATTERNS)
+        yield from scan_table(after_mda_tables[1], INCOME_KEYS, INCOME_PATTERNS)
+        yield from scan_table(after_mda_tables[2], CASHFLOW_KEYS, CASHFLOW_PATTERNS)
 
+def extract_important_metrics(data):
+    # Initialize a dictionary to store the extracted metrics
+    metrics = {}
+    for name, value in iter_table_metrics(data[0]):
+        metrics[name] = safe_float(value)
     return metrics
 
+def extract_metrics_batch(text_data):
+    """Extract metrics for every document into column lists keyed by ALL_METRIC_NAMES."""
+    # Only matched values are kept while walking, so text_data may be a
+    # one-shot iterator and each document can be dropped once scanned
+    num_docs = 0
+    hits = []
+    for i, doc in enumerate(text_data):
+        num_docs = i + 1
+        hits.extend((i, name, safe_float(value)) for name, value in iter_table_metrics(doc))
+
+    cols = {name: [None] * num_docs for name in ALL_METRIC_NAMES}
+    for i, name, value in hits:
+        cols[name][i] = value
+    return cols
+
 def save_metrics_to_csv(df, text_data, output_path):
-    metrics_list = [extract_important_metrics([data]) for data in text_data]
-    metrics_df = pd.DataFrame(metrics_list)
+    cols = extract_metrics_batch(text_data)
+    metrics_df = pd.DataFrame(cols, dtype="float64")
     combined_df = pd.concat([df, metrics_df], axis=1)
-    combined_df.to_csv(output_path, index=False)
+    # Arrow's writer quotes the header and all string cells, and writes
+    # whole-number floats without a decimal point (1000.0 -> 1000)
+    try:
+        table = pa.Table.from_pandas(combined_df, preserve_index=False)
+    except pa.ArrowException:
+        # Columns Arrow cannot type, e.g. object columns with mixed values
+        combined_df.to_csv(output_path, index=False)
+    else:
+        pacsv.write_csv(table, output_path, write_options=pacsv.WriteOptions(batch_size=8192))
     print(f"Metrics and data saved to {output_path}")
 
 if __name__ == "__main__": 
@@ -1,19 +1,26 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Dict, Any, Optional
 
 
 class DocumentSections(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     management_discussion: str
     risk_factors: str
     financial_statements: str
 
 class DocumentMetadata(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     company_name: str
     sector: str
     fiscal_year: str
 
 class FinancialMetrics(BaseModel):
     """Pydantic model for financial metrics extraction."""
+    # LLMs sometimes return bare numbers (e.g. 1098.7); keep them as strings
+    model_config = ConfigDict(frozen=True, coerce_numbers_to_str=True)
+
     revenue: Optional[str] = Field(None, description="Company revenue (e.g., '$1098.7 million')")
     gross_profit_margin: Optional[str] = Field(None, description="Gross profit margin percentage (e.g., '30.04%')")
     net_profit_margin: Optional[str] = Field(None, description="Net profit margin percentage (e.g., '0.43%')")
@@ -26,6 +33,8 @@ class FinancialMetrics(BaseModel):
 
 class ExtractedData(BaseModel):
     """Complete structure for extracted business analysis data."""
+    model_config = ConfigDict(frozen=True)
+
     metrics: FinancialMetrics = Field(default_factory=FinancialMetrics, description="Financial metrics extracted from the analysis")
     context: Dict[str, Any] = Field(default_factory=dict, description="Contextual information and company insights")
     competitor: str = Field(default="", description="Competitor analysis and market landscape information")
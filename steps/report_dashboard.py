@@ -1,5 +1,6 @@
 import re
 import json
+from html import escape
 from typing import Dict, Any
 from zenml import step
 from zenml.logger import get_logger
@@ -49,13 +50,13 @@ def financial_dashboard(response: Dict[str, Any]) -> HTMLString:
             {generate_context_html(extracted_data["context"])}
 
             <h2>🏆 Competitor Insights</h2>
-            <p>{extracted_data["competitor"]}</p>
+            <p>{escape(str(extracted_data["competitor"]))}</p>
 
             <h2>⚠️ Contradictions & Gap Analysis</h2>
-            <p>{extracted_data["contradictions"]}</p>
+            <p>{escape(str(extracted_data["contradictions"]))}</p>
 
             <h2>📝 Additional Context</h2>
-            <p>{extracted_data["additional_context"]}</p>
+            <p>{escape(str(extracted_data["additional_context"]))}</p>
         </div>
     </body>
     </html>
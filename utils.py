@@ -1,27 +1,140 @@
-from typing import Dict, Any
-import json
+from typing import Dict, Any, List, Optional
+from collections import OrderedDict
 from litellm import completion
+from concurrent.futures import ThreadPoolExecutor
+import diskcache
+import copy
+import hashlib
+import json
+from html import escape
 import os
 import re
+import sys
+import threading
 import ast
-from models.models import ExtractedData
+from models.models import ExtractedData, FinancialMetrics
 from config.prompts import EXTRACTION_SYSTEM_PROMPT, EXTRACTION_USER_PROMPT
 
-def extract_metrics(response: Dict[str, Any], model: str = "gpt-4o-mini") -> Dict[str, Any]:
+# Section keys of the synthesis agent's final answer
+_SHORT_OUTCOME_KEY = "1. Task outcome (short version)"
+_DETAILED_OUTCOME_KEY = "2. Task outcome (extremely detailed version)"
+_ADDITIONAL_CONTEXT_KEY = "3. Additional context (if relevant)"
+
+# (metric name, compiled pattern, value formatter) used by fallback_extraction.
+# Values must start with a digit and the label/value gap may not cross a
+# sentence, so "Ratio: n/a." never yields a bogus "." value.
+_FALLBACK_PATTERNS = [
+    ("Revenue", re.compile(r'\$?(\d[\d,]*(?:\.\d+)?)\s*million', re.IGNORECASE), "${} million".format),
+    ("Gross Profit Margin", re.compile(r'Gross Profit Margin[^.\n]*?(\d+(?:\.\d+)?)%', re.IGNORECASE), "{}%".format),
+    ("Net Profit Margin", re.compile(r'Net Profit Margin[^.\n]*?(\d+(?:\.\d+)?)%', re.IGNORECASE), "{}%".format),
+    ("Debt To Equity Ratio", re.compile(r'Debt to Equity Ratio[^.\n]*?(\d+(?:\.\d+)?)', re.IGNORECASE), str),
+    ("Total Debt Ratio", re.compile(r'Total Debt Ratio[^.\n]*?(\d+(?:\.\d+)?)', re.IGNORECASE), str),
+]
+
+# Display labels for FinancialMetrics fields, e.g. "gross_profit_margin" -> "Gross Profit Margin"
+_LABEL_MAP = {k: sys.intern(k.replace('_', ' ').title()) for k in FinancialMetrics.model_fields}
+
+# On-disk cache of LLM extraction results, shared across pipeline runs.
+# Opened on first use so importing the HTML helpers does not create the directory.
+_CACHE: Optional[diskcache.Cache] = None
+_CACHE_LOCK = threading.Lock()
+_CACHE_EXPIRE = 7 * 86400  # seconds
+
+# Bounded in-process LRU tier in front of the disk cache, keyed by the disk cache key
+_MEMORY_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_MEMORY_CACHE_SIZE = 256
+_MEMORY_LOCK = threading.Lock()
+
+# Changes to the prompts or the output schema invalidate both cache tiers
+_PROMPT_FINGERPRINT = hashlib.blake2b(
+    "\0".join((
+        EXTRACTION_SYSTEM_PROMPT,
+        EXTRACTION_USER_PROMPT,
+        json.dumps(ExtractedData.model_json_schema(), sort_keys=True),
+    )).encode(),
+    digest_size=16,
+).hexdigest()
+
+def _cache_key(model: str, input_text: str) -> str:
+    return hashlib.blake2b(f"{_PROMPT_FINGERPRINT}\0{model}\0{input_text}".encode(), digest_size=16).hexdigest()
+
+def _disk_cache() -> diskcache.Cache:
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                _CACHE = diskcache.Cache(os.getenv("LLM_CACHE_DIR", ".llm_cache"))
+    return _CACHE
+
+def _memory_get(key: str) -> Optional[Dict[str, Any]]:
+    # Hand out copies so callers mutating a result cannot change later hits
+    with _MEMORY_LOCK:
+        result = _MEMORY_CACHE.get(key)
+        if result is None:
+            return None
+        _MEMORY_CACHE.move_to_end(key)
+    return copy.deepcopy(result)
+
+def _memory_put(key: str, result: Dict[str, Any]) -> None:
+    result = copy.deepcopy(result)
+    with _MEMORY_LOCK:
+        _MEMORY_CACHE[key] = result
+        _MEMORY_CACHE.move_to_end(key)
+        while len(_MEMORY_CACHE) > _MEMORY_CACHE_SIZE:
+            _MEMORY_CACHE.popitem(last=False)
+
+def _memory_clear() -> None:
+    with _MEMORY_LOCK:
+        _MEMORY_CACHE.clear()
+
+def _lookup_cache(model: str, input_text: str) -> Optional[Dict[str, Any]]:
+    """Return a cached extraction from memory or disk, or None on a miss."""
+    key = _cache_key(model, input_text)
+    result = _memory_get(key)
+    if result is None:
+        result = _disk_cache().get(key)
+        if result is not None:
+            _memory_put(key, result)
+    return result
+
+def _has_enough_metrics(result: Dict[str, Any], min_metrics: int) -> bool:
+    """Whether a regex extraction found at least min_metrics values containing a digit."""
+    found = sum(1 for value in result["metrics"].values() if any(c.isdigit() for c in value))
+    return found >= min_metrics
+
+def extract_metrics(response: Dict[str, Any], model: str = "gpt-4o-mini", min_metrics: int = 3, force_llm: bool = False) -> Dict[str, Any]:
     """
     Extract financial metrics and insights using LiteLLM with Pydantic structured output.
     
+    The regex patterns used by fallback_extraction are tried first; the LLM is
+    only called when they find fewer than min_metrics metrics.
+    
     Args:
         response: A structured dictionary containing task outcomes and context.
         model: The LLM model to use for extraction
+        min_metrics: Number of regex-extracted metrics needed to skip the LLM
+        force_llm: Always use the LLM, e.g. for its richer competitor and contradiction fields
         
     Returns:
         A dictionary containing extracted financial metrics and relevant insights.
     """
-    input_text = prepare_input_text(response)
-    
-    # Create the extraction prompt
+    regex_result = None
+    if not force_llm:
+        regex_result = fallback_extraction(response)
+        if _has_enough_metrics(regex_result, min_metrics):
+            return regex_result
     
+    input_text = prepare_input_text(response)
+    result = _lookup_cache(model, input_text)
+    if result is None:
+        result = _llm_extract(input_text, model)
+    if result is None:
+        # Fallback to simple extraction, reusing the fast-path attempt if there was one
+        result = regex_result if regex_result is not None else fallback_extraction(response)
+    return result
+
+def _llm_extract(input_text: str, model: str) -> Optional[Dict[str, Any]]:
+    """Run the LLM extraction for prepared input text and cache it, or return None on failure."""
     try:
         # Make the LLM call with structured output
         response_obj = completion(
@@ -31,16 +144,17 @@ def extract_metrics(response: Dict[str, Any], model: str = "gpt-4o-mini") -> Dic
                 {"role": "user", "content": EXTRACTION_USER_PROMPT.format(input_text = input_text)}
             ],
             response_format=ExtractedData,
-            temperature=0.1  # Low temperature for consistent extraction
+            temperature=0.1,  # Low temperature for consistent extraction
+            num_retries=3  # Back off on transient rate limits instead of falling back
         )
         
-        # Parse the structured response
-        extracted_data = json.loads(response_obj.choices[0].message.content)
+        # Parse and validate the structured response in pydantic-core
+        extracted_data = ExtractedData.model_validate_json(response_obj.choices[0].message.content).model_dump()
         
         # Convert Pydantic model format to your expected format
         formatted_result = {
             "metrics": {
-                k.replace('_', ' ').title(): v 
+                _LABEL_MAP[k]: v 
                 for k, v in extracted_data["metrics"].items() 
                 if v is not None
             },
@@ -50,27 +164,65 @@ def extract_metrics(response: Dict[str, Any], model: str = "gpt-4o-mini") -> Dic
             "additional_context": extracted_data.get("additional_context", "")
         }
         
+        key = _cache_key(model, input_text)
+        _disk_cache().set(key, formatted_result, expire=_CACHE_EXPIRE)
+        _memory_put(key, formatted_result)
         return formatted_result
         
     except Exception as e:
         print(f"Error in LLM extraction: {e}")
-        # Fallback to simple extraction
-        return fallback_extraction(response)
+        return None
 
-def generate_metrics_html(metrics: Dict[str, str]) -> str:
+extract_metrics.cache_clear = _memory_clear
+
+def extract_metrics_batch(responses: List[Dict[str, Any]], model: str = "gpt-4o-mini", max_workers: int = 8, min_metrics: int = 3, force_llm: bool = False) -> List[Dict[str, Any]]:
     """
-    Generate clean HTML for financial metrics display.
+    Extract metrics for several responses, issuing cache misses to the LLM in parallel.
     
     Args:
-        metrics: Dictionary of extracted financial metrics.
+        responses: Structured response dictionaries to extract from.
+        model: The LLM model to use for extraction
+        max_workers: Maximum number of concurrent LLM calls
+        min_metrics: Number of regex-extracted metrics needed to skip the LLM
+        force_llm: Always use the LLM instead of the regex fast path
         
     Returns:
-        HTML string with styled metrics display.
+        Extracted data dictionaries in the same order as responses.
     """
-    if not metrics:
-        return '<div class="no-metrics"><p>No financial metrics available.</p></div>'
+    results = []
+    # Indices of uncached responses, grouped by prepared input so each distinct
+    # input is sent to the LLM once
+    misses: Dict[str, List[int]] = {}
+    # Fast-path regex results, reused if the LLM call for that response fails
+    regex_results: Dict[int, Dict[str, Any]] = {}
+    for i, r in enumerate(responses):
+        result = None
+        if not force_llm:
+            regex_results[i] = fallback_extraction(r)
+            if _has_enough_metrics(regex_results[i], min_metrics):
+                result = regex_results[i]
+        if result is None:
+            input_text = prepare_input_text(r)
+            result = _lookup_cache(model, input_text)
+            if result is None:
+                misses.setdefault(input_text, []).append(i)
+        results.append(result)
     
-    html = '''
+    if misses:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(misses))) as executor:
+            extracted = executor.map(lambda input_text: _llm_extract(input_text, model), misses)
+            for indices, result in zip(misses.values(), extracted):
+                for n, i in enumerate(indices):
+                    # Failed extractions fall back per response, as in extract_metrics
+                    if result is None:
+                        results[i] = regex_results.get(i) or fallback_extraction(responses[i])
+                    else:
+                        # Duplicates get their own copy so results stay independent
+                        results[i] = result if n == 0 else copy.deepcopy(result)
+    
+    return results
+
+_METRICS_HTML_PREFIX = '''
     <style>
     .metrics-container {
         font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif;
@@ -129,21 +281,38 @@ def generate_metrics_html(metrics: Dict[str, str]) -> str:
         <div class="metrics-header">Financial Metrics</div>
         <div class="metrics-grid">
     '''
+
+_METRICS_HTML_SUFFIX = '''
+        </div>
+    </div>
+    '''
+
+def generate_metrics_html(metrics: Dict[str, str]) -> str:
+    """
+    Generate clean HTML for financial metrics display.
+    
+    Args:
+        metrics: Dictionary of extracted financial metrics.
+        
+    Returns:
+        HTML string with styled metrics display.
+    """
+    if not metrics:
+        return '<div class="no-metrics"><p>No financial metrics available.</p></div>'
     
-    for metric, value in metrics.items():
-        html += f'''
+    parts = [_METRICS_HTML_PREFIX]
+    parts.extend(
+        f'''
         <div class="metric-card">
-            <div class="metric-label">{metric}</div>
-            <div class="metric-value">{value}</div>
+            <div class="metric-label">{escape(str(metric))}</div>
+            <div class="metric-value">{escape(str(value))}</div>
         </div>
         '''
+        for metric, value in metrics.items()
+    )
+    parts.append(_METRICS_HTML_SUFFIX)
     
-    html += '''
-        </div>
-    </div>
-    '''
-    
-    return html
+    return "".join(parts)
 
 def prepare_input_text(response: Dict[str, Any]) -> str:
     """
@@ -158,22 +327,21 @@ def prepare_input_text(response: Dict[str, Any]) -> str:
     text_parts = []
     
     # Add short version
-    short_version = response.get("1. Task outcome (short version)", "")
+    short_version = response.get(_SHORT_OUTCOME_KEY, "")
     if short_version:
         text_parts.append(f"SUMMARY: {short_version}")
     
     # Add detailed version
-    detailed_outcome = response.get("2. Task outcome (extremely detailed version)", {})
+    detailed_outcome = response.get(_DETAILED_OUTCOME_KEY, {})
     if detailed_outcome:
         text_parts.append("DETAILED ANALYSIS:")
         if isinstance(detailed_outcome, dict):
-            for key, value in detailed_outcome.items():
-                text_parts.append(f"{key}: {value}")
+            text_parts.extend(f"{key}: {value}" for key, value in detailed_outcome.items())
         else:
             text_parts.append(str(detailed_outcome))
     
     # Add additional context
-    additional_context = response.get("3. Additional context (if relevant)", "")
+    additional_context = response.get(_ADDITIONAL_CONTEXT_KEY, "")
     if additional_context:
         text_parts.append(f"ADDITIONAL CONTEXT: {additional_context}")
     
@@ -198,7 +366,7 @@ def fallback_extraction(response: Dict[str, Any]) -> Dict[str, Any]:
         "additional_context": ""
     }
     
-    detailed_outcome = response.get("2. Task outcome (extremely detailed version)", {})
+    detailed_outcome = response.get(_DETAILED_OUTCOME_KEY, {})
     
     if isinstance(detailed_outcome, dict):
         extracted_data["context"] = detailed_outcome
@@ -207,26 +375,10 @@ def fallback_extraction(response: Dict[str, Any]) -> Dict[str, Any]:
         financial_text = detailed_outcome.get("Financial Metrics", "")
         if financial_text:
             # Simple pattern matching as fallback
-            import re
-            
-            patterns = {
-                "Revenue": r'\$?([\d,\.]+)\s*million',
-                "Gross Profit Margin": r'Gross Profit Margin.*?([\d\.]+)%',
-                "Net Profit Margin": r'Net Profit Margin.*?([\d\.]+)%',
-                "Debt To Equity Ratio": r'Debt to Equity Ratio.*?([\d\.]+)',
-                "Total Debt Ratio": r'Total Debt Ratio.*?([\d\.]+)'
-            }
-            
-            for metric, pattern in patterns.items():
-                match = re.search(pattern, financial_text, re.IGNORECASE)
+            for metric, pattern, fmt in _FALLBACK_PATTERNS:
+                match = pattern.search(financial_text)
                 if match:
-                    value = match.group(1)
-                    if metric == "Revenue":
-                        extracted_data["metrics"][metric] = f"${value} million"
-                    elif "Margin" in metric:
-                        extracted_data["metrics"][metric] = f"{value}%"
-                    else:
-                        extracted_data["metrics"][metric] = value
+                    extracted_data["metrics"][metric] = fmt(match.group(1))
         
         # Extract competitor info
         extracted_data["competitor"] = detailed_outcome.get("Competitor Analysis", "")
@@ -234,7 +386,7 @@ def fallback_extraction(response: Dict[str, Any]) -> Dict[str, Any]:
         # Extract contradictions
         extracted_data["contradictions"] = detailed_outcome.get("Contradictory Analysis", "")
     
-    extracted_data["additional_context"] = response.get("3. Additional context (if relevant)", "")
+    extracted_data["additional_context"] = response.get(_ADDITIONAL_CONTEXT_KEY, "")
     
     return extracted_data
 
@@ -246,20 +398,7 @@ def string_to_dict(input_str):
         print(f"Error converting string to dict: {e}")
         return None
 
-def generate_context_html(context: Dict[str, Any]) -> str:
-    """
-    Converts context dictionary to structured HTML with modern styling.
-
-    Args:
-        context: A dictionary containing contextual information from the analysis.
-
-    Returns:
-        A string containing HTML content with styling.
-    """
-    if not context:
-        return '<div class="no-context"><p>No context available.</p></div>'
-
-    html = '''
+_CONTEXT_HTML_PREFIX = '''
     <style>
     .context-container {
         font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif;
@@ -332,52 +471,69 @@ def generate_context_html(context: Dict[str, Any]) -> str:
         <div class="context-header">Business Analysis Context</div>
     '''
 
+def generate_context_html(context: Dict[str, Any]) -> str:
+    """
+    Converts context dictionary to structured HTML with modern styling.
+
+    Args:
+        context: A dictionary containing contextual information from the analysis.
+
+    Returns:
+        A string containing HTML content with styling.
+    """
+    if not context:
+        return '<div class="no-context"><p>No context available.</p></div>'
+
+    parts = [_CONTEXT_HTML_PREFIX]
+
     # Handle different types of context input
     if isinstance(context, dict):
         for section_key, section_value in context.items():
             if section_value:  # Only show non-empty sections
-                html += f'''
+                parts.append(f'''
                 <div class="context-section">
-                    <div class="section-title">{section_key.replace('_', ' ')}</div>
+                    <div class="section-title">{escape(section_key.replace('_', ' '))}</div>
                     <div class="section-content">
-                '''
+                ''')
                 
                 if isinstance(section_value, str):
                     # Handle string values - convert to proper HTML
-                    content = format_text_content(section_value)
-                    html += content
+                    parts.append(format_text_content(section_value))
                 elif isinstance(section_value, (list, tuple)):
                     # Handle list values
-                    html += '<ul class="context-list">'
-                    for item in section_value:
-                        html += f'<li>{str(item)}</li>'
-                    html += '</ul>'
+                    parts.append('<ul class="context-list">')
+                    parts.extend(f'<li>{escape(str(item))}</li>' for item in section_value)
+                    parts.append('</ul>')
                 elif isinstance(section_value, dict):
                     # Handle nested dictionary values
-                    for sub_key, sub_value in section_value.items():
-                        html += f'<p><strong>{sub_key}:</strong> {str(sub_value)}</p>'
+                    parts.extend(
+                        f'<p><strong>{escape(str(sub_key))}:</strong> {escape(str(sub_value))}</p>'
+                        for sub_key, sub_value in section_value.items()
+                    )
                 else:
-                    html += f'<p>{str(section_value)}</p>'
+                    parts.append(f'<p>{escape(str(section_value))}</p>')
                 
-                html += '''
+                parts.append('''
                     </div>
                 </div>
-                '''
+                ''')
     
     elif isinstance(context, str):
         # Handle legacy string format
-        html += f'''
+        parts.append(f'''
         <div class="context-section">
             <div class="section-content">
                 {format_text_content(context)}
             </div>
         </div>
-        '''
+        ''')
     
-    html += '</div>'
-    return html
+    parts.append('</div>')
+    return "".join(parts)
 
 
+_HEADING_TAGS = {"### ": "h4", "#### ": "h5"}
+
 def format_text_content(text: str) -> str:
     """
     Format text content with basic markdown-like parsing.
@@ -396,7 +552,8 @@ def format_text_content(text: str) -> str:
     
     lines = text.strip().splitlines()
     for line in lines:
-        line = line.strip()
+        # Escape before adding markup; the markdown prefixes contain no escaped characters
+        line = escape(line.strip())
         
         if not line:
             # Close any open lists on blank lines
@@ -408,20 +565,23 @@ def format_text_content(text: str) -> str:
                 in_ol = False
             continue
         
-        if line.startswith("### "):
-            html_parts.append(f"<h4>{line[4:].strip()}</h4>")
-        elif line.startswith("#### "):
-            html_parts.append(f"<h5>{line[5:].strip()}</h5>")
-        elif re.match(r"- ", line):
+        # Markdown headings are keyed by everything up to the first space
+        prefix = line[:line.find(" ") + 1]
+        tag = _HEADING_TAGS.get(prefix)
+        dot = line.find(".")
+        
+        if tag:
+            html_parts.append(f"<{tag}>{line[len(prefix):].strip()}</{tag}>")
+        elif line.startswith("- "):
             if not in_ul:
                 html_parts.append('<ul class="context-list">')
                 in_ul = True
             html_parts.append(f"<li>{line[2:].strip()}</li>")
-        elif re.match(r"\d+\.", line):
+        elif dot > 0 and line[:dot].isdecimal():
             if not in_ol:
                 html_parts.append('<ol class="context-list">')
                 in_ol = True
-            html_parts.append(f"<li>{line[line.find('.') + 1:].strip()}</li>")
+            html_parts.append(f"<li>{line[dot + 1:].strip()}</li>")
         else:
             html_parts.append(f"<p>{line}</p>")
     